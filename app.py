@@ -11,8 +11,14 @@ from google import genai
 from google.genai import types
 
 from rag.retriever import EhimeRetriever, RetrievalItem
-from rag.prompts import build_plan_prompt, ITINERARY_SCHEMA, build_refine_plan_prompt
+from rag.prompts import build_plan_prompt, ITINERARY_SCHEMA
+from rag.conversation import GeminiCacheBackend, PlanConversation
+from rag.metadata import filter_from_conditions
+from rag.singleflight import fingerprint
 from utils.formatting import plan_json_to_markdown
+from utils.jobs import JobManager, DONE, FAILED, CANCELLED
+
+JOB_POLL_SECONDS = 0.7
 
 st.set_page_config(
     page_title="Ehime Tour Planner — RAG × Tavily × Gemini",
@@ -34,6 +40,76 @@ if not GEMINI_API_KEY or not TAVILY_API_KEY:
 client = genai.Client(api_key=GEMINI_API_KEY)
 retriever = EhimeRetriever(api_key=TAVILY_API_KEY)
 
+
+# --- Background Jobs ---
+# プロセス内で1つ（全セッション共有）の有界ワーカープール
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    return JobManager(max_workers=4)
+
+jobs = get_job_manager()
+
+
+def run_plan_job(retriever, client, items, query, params, progress):
+    # RAG（0〜60%）→ 生成（60〜100%）。条件はクリック時点のスナップショット
+    top_chunks, used_sources = retriever.retrieve_for_plan(
+        items=items,
+        user_query=query,
+        k=8,
+        progress=lambda stage, frac: progress(stage, frac * 0.6),
+        # エリア・関心テーマ・旅行月で候補チャンクを事前に絞り込む
+        chunk_filter=filter_from_conditions(
+            params["start_area"], params["interests"], params["start_date"], params["trip_days"],
+        ),
+    )
+    progress("Gemini で旅程を構成中", 0.6)
+    prompt = build_plan_prompt(**params, sources=used_sources, context=top_chunks)
+    resp = client.models.generate_content(
+        model="gemini-2.5-flash-lite",
+        contents=prompt,
+        config={
+        "response_mime_type": "application/json",
+        "response_json_schema": ITINERARY_SCHEMA,  # JSON Schema (dict)
+        },
+    )
+    progress("生成結果を解析", 0.95)
+    return {"plan_json": json.loads(resp.text), "context": top_chunks, "sources": used_sources}
+
+
+def start_job(kind: str, key: str, fn, *args, **kwargs) -> None:
+    # 同じ種類のジョブが別条件で走っていれば置き換える（同条件なら共有して重複させない）
+    current = jobs.get(st.session_state.jobs.get(kind))
+    if current is not None and not current.finished:
+        if current.key == key:
+            return
+        jobs.cancel(current.id)
+    st.session_state.jobs[kind] = jobs.submit(kind, key, fn, *args, **kwargs).id
+
+
+def poll_job(kind: str, label: str, on_done) -> bool:
+    """ジョブの進捗を表示し、完了していれば結果をセッションに取り込む。実行中なら True。"""
+    job = jobs.get(st.session_state.jobs.get(kind))
+    if job is None:
+        st.session_state.jobs.pop(kind, None)
+        return False
+    if not job.finished:
+        st.progress(job.progress, text=f"{label}: {job.stage}")
+        if st.button("キャンセル", key=f"cancel_{kind}"):
+            jobs.cancel(job.id)
+            st.session_state.jobs.pop(kind, None)
+            st.info("キャンセルしました。")
+            return False
+        return True
+
+    st.session_state.jobs.pop(kind, None)
+    if job.status == DONE:
+        on_done(job.result)
+    elif job.status == FAILED:
+        st.error(f"{label}に失敗しました: {job.error}")
+    elif job.status == CANCELLED:
+        st.info("キャンセルしました。")
+    return False
+
 # --- Session State ---
 if "items" not in st.session_state:
     st.session_state.items = []
@@ -41,6 +117,8 @@ if "plan_json" not in st.session_state:
     st.session_state.plan_json = None
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "jobs" not in st.session_state:
+    st.session_state.jobs = {}
 
 
 # --- Sidebar: 条件入力 ---
@@ -100,15 +178,21 @@ with colL:
     query = st.text_input("検索キーワード（必要に応じて編集）", q_default)
     max_results = st.slider("最大取得サイト数", 3, 15, 8)
     if st.button("関連ページを収集"):
-        with st.spinner("Tavilyで検索・要約中..."):
-            items = retriever.search_and_prepare(
-                query=query, 
-                max_results=max_results,
-                add_web_search=add_web_search
-            )
+        start_job(
+            "search",
+            fingerprint("search", query, max_results, add_web_search),
+            retriever.search_and_prepare,
+            query=query,
+            max_results=max_results,
+            add_web_search=add_web_search,
+        )
+
+    def _attach_items(items):
         st.session_state["items"] = [i.model_dump() for i in items]
         st.success(f"{len(items)} 件の候補を取り込みました。右ペインで内容を確認できます。")
 
+    poll_job("search", "Tavilyで検索・要約", _attach_items)
+
 with colR:
     st.markdown("**候補リスト（出典URL明示）**")
     items_state = st.session_state.get("items", [])
@@ -128,35 +212,36 @@ if generate_btn:
         st.warning("まず関連ページを収集してください。")
         st.stop()
 
-    with st.spinner("RAG で関連チャンクを選別中..."):
-        top_chunks, used_sources = retriever.retrieve_for_plan(
-            items=[RetrievalItem(**i) for i in items_state],
-            user_query=query,
-            k=8,
-        )
+    params = dict(
+        trip_days=trip_days, start_date=str(start_date), party=party,
+        transport=transport, interests=interests, start_area=start_area,
+        with_kids=with_kids, pace=pace, start_end_point=start_end_point,
+    )
+    start_job(
+        "plan",
+        fingerprint("plan", items_state, query, params),
+        run_plan_job,
+        retriever, client, [RetrievalItem(**i) for i in items_state], query, params,
+    )
 
-    with st.spinner("Gemini で旅程を構成中..."):
-        prompt = build_plan_prompt(
-            trip_days=trip_days, start_date=str(start_date), party=party,
-            transport=transport, interests=interests, start_area=start_area,
-            with_kids=with_kids, pace=pace, start_end_point=start_end_point,
-            sources=used_sources, context=top_chunks,
-        )
-        resp = client.models.generate_content(
-            model="gemini-2.5-flash-lite",
-            contents=prompt,
-            config={
-            "response_mime_type": "application/json",
-            "response_json_schema": ITINERARY_SCHEMA,  # JSON Schema (dict)
-            },
-        )
 
-        st.session_state.plan_json = json.loads(resp.text)
-        st.session_state.messages = [{
-            "role": "assistant",
-            "content": "プランの初稿を作成しました。変更したい点があれば、下のチャット欄から具体的に教えてください。\n（例: 2日目はもっとゆったりしたプランにして、〇〇を追加して）"
-        }]
-        st.rerun()
+def _attach_plan(result):
+    st.session_state.plan_json = result["plan_json"]
+    # 修正チャット用: 初回の参考要点と出典をキャッシュに載せて使い回す
+    if st.session_state.get("conversation") is not None:
+        st.session_state.conversation.close()
+    st.session_state.conversation = PlanConversation(
+        backend=GeminiCacheBackend(client),
+        plan=result["plan_json"],
+        context=result["context"],
+        sources=result["sources"],
+    )
+    st.session_state.messages = [{
+        "role": "assistant",
+        "content": "プランの初稿を作成しました。変更したい点があれば、下のチャット欄から具体的に教えてください。\n（例: 2日目はもっとゆったりしたプランにして、〇〇を追加して）"
+    }]
+
+poll_job("plan", "旅程を生成", _attach_plan)
 
 # 3. プラン表示とチャットでの修正
 if st.session_state.plan_json:
@@ -177,6 +262,14 @@ if st.session_state.plan_json:
         data=md,
     )
 
+    conversation = st.session_state.get("conversation")
+    if conversation is not None and conversation.metrics.turns:
+        m = conversation.metrics
+        st.caption(
+            f"修正 {m.turns} 回 / キャッシュ再利用トークン {m.cached_tokens:,} / "
+            f"入力トークン {m.prompt_tokens:,}（再利用率 {m.reuse_ratio:.0%}）"
+        )
+
     # --- 参照元の表示 ---
     st.subheader("3) 参照元（いよ観ネット等）")
     for s in st.session_state.plan_json.get("sources", []):
@@ -196,25 +289,27 @@ if prompt := st.chat_input("プランの修正点を入力してください"):
 
     with st.chat_message("assistant"):
         with st.spinner("プランを修正中..."):
-            refine_prompt = build_refine_plan_prompt(
-                existing_plan=st.session_state.plan_json,
-                user_request=prompt,
-            )
-            resp = client.models.generate_content(
-                model="gemini-2.5-flash-lite",
-                contents=refine_prompt,
-                config={
-                    "response_mime_type": "application/json",
-                    "response_json_schema": ITINERARY_SCHEMA,
-                },
-            )
-
-            try:
-                new_plan = json.loads(resp.text)
+            conversation = st.session_state.get("conversation")
+            if conversation is None:
+                conversation = PlanConversation(
+                    backend=GeminiCacheBackend(client),
+                    plan=st.session_state.plan_json,
+                )
+                st.session_state.conversation = conversation
+            new_plan, raw_text = conversation.refine(prompt)
+
+            if new_plan is not None:
                 st.session_state.plan_json = new_plan
                 response_text = "プランを修正しました。いかがでしょうか？ さらに修正したい点があれば、教えてください。"
-            except json.JSONDecodeError:
-                response_text = "プランの修正に失敗しました。形式が正しくないようです。もう一度試しますか？\n" + resp.text
+            else:
+                response_text = "プランの修正に失敗しました。形式が正しくないようです。もう一度試しますか？\n" + raw_text
 
             st.session_state.messages.append({"role": "assistant", "content": response_text})
             st.rerun()
+
+# --- 実行中ジョブのポーリング ---
+# ジョブはワーカースレッドで進むため、ここで短く待って再描画するだけ（操作による再実行でも結果は失われない）
+# 完了済みでも未取り込みのジョブが残っていれば、次の実行で poll_job が取り込む
+if st.session_state.jobs:
+    time.sleep(JOB_POLL_SECONDS)
+    st.rerun()
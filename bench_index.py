@@ -0,0 +1,85 @@
+"""
+類似検索バックエンドのレイテンシ比較（ランダムベクトル, d=768）。
+
+    python bench_index.py                 # 既定サイズ
+    python bench_index.py --rows 2000 20000 --queries 1 16
+
+比較対象:
+- naive        : 旧実装相当（毎回 X 全体を正規化 + 全件 argsort, 1クエリずつ）
+- numpy-f32    : NumpyIndex（事前正規化 float32 + argpartition, 一括クエリ）
+- numpy-f16    : NumpyIndex（float16 保持）
+- numpy-memmap : NumpyIndex（np.memmap 上で行ブロックごとに評価）
+- faiss        : faiss IndexFlatIP（導入済みの場合のみ）
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from rag.vector_index import FaissIndex, NumpyIndex, faiss
+
+
+def naive_search(X: np.ndarray, Q: np.ndarray, k: int):
+    out = []
+    for q in Q:
+        Xn = X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-9)
+        qn = q / (np.linalg.norm(q) + 1e-9)
+        sims = Xn @ qn
+        out.append(np.argsort(-sims)[:k])
+    return np.vstack(out)
+
+
+def timeit(fn, repeat: int) -> float:
+    fn()  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    ap.add_argument("--queries", type=int, nargs="+", default=[1, 8, 32])
+    ap.add_argument("--dim", type=int, default=768)
+    ap.add_argument("-k", type=int, default=8)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--chunk-rows", type=int, default=16384)
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>8} {'queries':>8} {'backend':>13} {'ms/batch':>10} {'ms/query':>10}")
+    for n in args.rows:
+        X = rng.standard_normal((n, args.dim), dtype=np.float32)
+        with tempfile.TemporaryDirectory() as tmp:
+            backends = {
+                "numpy-f32": NumpyIndex(X),
+                "numpy-f16": NumpyIndex(X, dtype="float16"),
+                "numpy-memmap": NumpyIndex(
+                    X, chunk_rows=args.chunk_rows, memmap_path=os.path.join(tmp, "X.f32"),
+                ),
+            }
+            if faiss is not None:
+                backends["faiss"] = FaissIndex(X)
+
+            for m in args.queries:
+                Q = rng.standard_normal((m, args.dim), dtype=np.float32)
+                rows = [("naive", timeit(lambda: naive_search(X, Q, args.k), args.repeat))]
+                for name, index in backends.items():
+                    rows.append((name, timeit(lambda: index.search(Q, args.k), args.repeat)))
+                for name, ms in rows:
+                    print(f"{n:>8} {m:>8} {name:>13} {ms:>10.2f} {ms / m:>10.3f}")
+
+            # 一致確認: float32 の NumPy 実装は faiss と同じ上位を返すはず
+            if "faiss" in backends:
+                Q = rng.standard_normal((4, args.dim), dtype=np.float32)
+                _, I_np = backends["numpy-f32"].search(Q, args.k)
+                _, I_fa = backends["faiss"].search(Q, args.k)
+                print(f"{n:>8} top-{args.k} agreement numpy-f32 vs faiss: {np.mean(I_np == I_fa):.3f}")
+            del backends
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# リポジトリ直下をインポートパスに入れ、素の `pytest` で rag / utils を解決できるようにする
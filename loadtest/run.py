@@ -0,0 +1,400 @@
+"""
+app.py の多セッション負荷試験（外部 API はスタブ、ネットワーク不要）。
+
+    python -m loadtest.run --users 20 --concurrency 10 --refines 2
+    python -m loadtest.run --users 50 --latency-scale 0.5 --error-rate 0.05 --json result.json
+
+各仮想ユーザーは Streamlit AppTest 上で「関連ページを収集 → プラン生成 → チャット修正×N」を実行する。
+レポート: スループット、ステージ別レイテンシ分位点、1セッションあたりのメモリ増分、CPU 使用率。
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional
+from unittest import mock
+
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.pages_manager import PagesManager
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1 import app_test as _app_test
+from streamlit.testing.v1 import local_script_runner as _local_script_runner
+from streamlit.testing.v1.util import patch_config_options
+
+from loadtest.stubs import StubConfig, installed
+
+DEFAULT_APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+STAGES = ["load", "collect", "generate", "refine"]
+REFINE_REQUESTS = ["2日目はもっとゆったりしたプランにして", "温泉をもう1か所追加して", "昼食は名物グルメにして"]
+
+
+@dataclass
+class SessionResult:
+    user: int
+    timings: Dict[str, List[float]] = field(default_factory=lambda: {s: [] for s in STAGES})
+    error: str = ""
+    app: Optional[AppTest] = field(default=None, repr=False)
+
+
+def _state(at: AppTest, key: str, default=None):
+    try:
+        return at.session_state[key]
+    except KeyError:
+        return default
+
+
+def _settle(at: AppTest, timeout: float, poll: float = 0.2) -> None:
+    """実行中のバックグラウンドジョブが取り込まれるまで再実行を続ける。"""
+    deadline = time.monotonic() + timeout
+    at.run(timeout=timeout)
+    while _state(at, "jobs") and time.monotonic() < deadline:
+        time.sleep(poll)
+        at.run(timeout=max(1.0, deadline - time.monotonic()))
+    if _state(at, "jobs"):
+        raise TimeoutError("background job did not finish in time")
+
+
+def _check(at: AppTest, stage: str) -> None:
+    if at.exception:
+        raise RuntimeError(f"{stage}: {at.exception[0].message}")
+    if at.error:
+        raise RuntimeError(f"{stage}: {at.error[0].value}")
+
+
+def _button(at: AppTest, stage: str, label: str, sidebar: bool = False):
+    buttons = at.sidebar.button if sidebar else at.button
+    for b in buttons:
+        if b.label == label:
+            return b
+    raise RuntimeError(f"{stage}: button {label!r} not found (rendered: {[b.label for b in buttons]})")
+
+
+def _timed(result: SessionResult, stage: str, fn) -> None:
+    t0 = time.perf_counter()
+    fn()
+    result.timings[stage].append(time.perf_counter() - t0)
+
+
+def run_session(user: int, app_path: str, refines: int, timeout: float) -> SessionResult:
+    result = SessionResult(user=user)
+    # Secrets は concurrent_apptest で共有する（at.secrets は実行ごとに st.secrets を差し替えるため使わない）
+    at = AppTest.from_file(app_path, default_timeout=timeout)
+    result.app = at
+    try:
+        _timed(result, "load", lambda: at.run(timeout=timeout))
+        _check(at, "load")
+
+        collect = _button(at, "collect", "関連ページを収集")
+        _timed(result, "collect", lambda: (collect.click(), _settle(at, timeout)))
+        _check(at, "collect")
+        if not _state(at, "items"):
+            raise RuntimeError("collect: no items attached")
+
+        generate = _button(at, "generate", "プラン生成", sidebar=True)
+        _timed(result, "generate", lambda: (generate.click(), _settle(at, timeout)))
+        _check(at, "generate")
+        if not _state(at, "plan_json"):
+            raise RuntimeError("generate: no plan attached")
+
+        for i in range(refines):
+            text = REFINE_REQUESTS[i % len(REFINE_REQUESTS)]
+            _timed(result, "refine", lambda: (at.chat_input[0].set_value(text), at.run(timeout=timeout)))
+            _check(at, "refine")
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+# concurrent_apptest は AppTest の非公開実装（Runtime._instance / PagesManager.uses_pages_directory /
+# app_test・local_script_runner の ScriptCache / app_test.patch_config_options）に依存する。
+# 動作確認済みの版以外では黙って壊れないよう即時に止める。
+TESTED_STREAMLIT_VERSIONS = ("1.66",)
+
+
+def check_streamlit_version() -> None:
+    version = ".".join(st.__version__.split(".")[:2])
+    if version not in TESTED_STREAMLIT_VERSIONS:
+        raise RuntimeError(
+            f"loadtest is verified with streamlit {', '.join(TESTED_STREAMLIT_VERSIONS)}.x only "
+            f"(installed: {st.__version__}). Re-verify concurrent_apptest and update TESTED_STREAMLIT_VERSIONS."
+        )
+    missing = [
+        f"app_test.{name}" for name in ("Runtime", "PagesManager", "ScriptCache", "patch_config_options")
+        if not hasattr(_app_test, name)
+    ]
+    if not hasattr(_local_script_runner, "ScriptCache"):
+        missing.append("local_script_runner.ScriptCache")
+    if not hasattr(Runtime, "_instance"):
+        missing.append("Runtime._instance")
+    if not hasattr(PagesManager, "uses_pages_directory"):
+        missing.append("PagesManager.uses_pages_directory")
+    if missing:
+        raise RuntimeError(f"streamlit AppTest internals changed (missing: {missing})")
+
+
+class _SharedRuntimeMeta(type):
+    # AppTest は実行ごとに Runtime._instance を差し替えて None に戻す → 並行実行で壊れる。
+    # 最初に作られたモックを負荷試験の間ずっと使い、None への巻き戻しは無視する。
+    @property
+    def _instance(cls):
+        return Runtime._instance
+
+    @_instance.setter
+    def _instance(cls, value):
+        if value is not None and Runtime._instance is None:
+            Runtime._instance = value
+
+
+class _SharedRuntime(Runtime, metaclass=_SharedRuntimeMeta):
+    pass
+
+
+class _SharedPagesManagerMeta(type):
+    # 同様に AppTest は実行ごとに uses_pages_directory を None に戻してから再判定する。
+    # 判定結果はアプリで固定なので、最初の値を保持して None への巻き戻しを無視する。
+    @property
+    def uses_pages_directory(cls):
+        return PagesManager.uses_pages_directory
+
+    @uses_pages_directory.setter
+    def uses_pages_directory(cls, value):
+        if value is not None:
+            PagesManager.uses_pages_directory = value
+
+
+class _SharedPagesManager(PagesManager, metaclass=_SharedPagesManagerMeta):
+    pass
+
+
+@contextmanager
+def concurrent_apptest(secrets: Dict[str, str]):
+    """AppTest が実行ごとに書き換えるプロセス全体の状態を固定し、複数セッションを並行実行できるようにする。"""
+    shared = Secrets()
+    shared._secrets = secrets
+    # 本番と同じくバイトコードはプロセスで1回だけコンパイルする。スクリプトを実行するのは
+    # LocalScriptRunner 側のキャッシュなので両方を共有にする（CPython 3.11 は並行 ast.parse で
+    # SystemError を出し、そのセッションは何も描画されない）
+    script_cache = ScriptCache()
+    with mock.patch.object(st, "secrets", shared), \
+         mock.patch.object(_app_test, "ScriptCache", lambda: script_cache), \
+         mock.patch.object(_local_script_runner, "ScriptCache", lambda: script_cache), \
+         mock.patch.object(_app_test, "Runtime", _SharedRuntime), \
+         mock.patch.object(_app_test, "PagesManager", _SharedPagesManager), \
+         patch_config_options({"global.appTest": True}), \
+         mock.patch.object(_app_test, "patch_config_options", lambda *a, **k: nullcontext()):
+        try:
+            yield
+        finally:
+            Runtime._instance = None
+            PagesManager.uses_pages_directory = None
+
+
+class CpuSampler:
+    """プロセス CPU 時間を一定間隔で読み、使用率（全コア比）の推移を記録する。"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self) -> None:
+        ncpu = os.cpu_count() or 1
+        last_cpu, last_wall = sum(os.times()[:2]), time.perf_counter()
+        while not self._stop.wait(self.interval):
+            cpu, wall = sum(os.times()[:2]), time.perf_counter()
+            self.samples.append((cpu - last_cpu) / max(1e-9, wall - last_wall) / ncpu)
+            last_cpu, last_wall = cpu, wall
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _rss_mb() -> float:
+    # 現在の RSS（Linux は /proc、その他は最大 RSS で代用）
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    v = sorted(values)
+
+    def pct(p: float) -> float:
+        return v[min(len(v) - 1, int(round(p / 100 * (len(v) - 1))))]
+
+    return {
+        "count": len(v),
+        "mean": sum(v) / len(v),
+        "p50": pct(50), "p90": pct(90), "p95": pct(95), "p99": pct(99),
+        "max": v[-1],
+    }
+
+
+def _conversation_metrics(results: List[SessionResult]) -> Dict[str, int]:
+    total = {"prompt_tokens": 0, "cached_tokens": 0, "cache_builds": 0}
+    for r in results:
+        conv = _state(r.app, "conversation") if r.app is not None else None
+        if conv is None:
+            continue
+        for key in total:
+            total[key] += getattr(conv.metrics, key)
+    return total
+
+
+def run_load_test(
+    users: int,
+    concurrency: int,
+    refines: int,
+    app_path: str = DEFAULT_APP,
+    timeout: float = 120.0,
+    stub_config: Optional[StubConfig] = None,
+    trace_memory: bool = False,
+) -> dict:
+    from rag.retriever import EhimeRetriever
+
+    check_streamlit_version()
+    # AppTest は相対パスを呼び出し元ファイル基準で解決するため絶対パスにしておく
+    app_path = os.path.abspath(app_path)
+    if trace_memory:
+        # Python ヒープを正確に追えるがオーバーヘッドが大きい（レイテンシ計測とは分けて使う）
+        tracemalloc.start()
+    secrets = {"GEMINI_API_KEY": "stub", "TAVILY_API_KEY": "tvly-stub"}
+    with installed(stub_config), concurrent_apptest(secrets):
+        # 初回 import・キャッシュ初期化のコストは計測から除外する
+        warmup = run_session(-1, app_path, refines=0, timeout=timeout)
+        if warmup.error:
+            raise RuntimeError(f"warm-up session failed: {warmup.error}")
+        del warmup
+        coalesce_before = EhimeRetriever.coalesce_stats()
+        mem_before, _ = tracemalloc.get_traced_memory()
+        rss_before = _rss_mb()
+
+        t0 = time.perf_counter()
+        with CpuSampler() as cpu, ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(run_session, u, app_path, refines, timeout) for u in range(users)]
+            results = [f.result() for f in futures]
+        wall = time.perf_counter() - t0
+
+        # セッション状態を保持したまま計測（= 同時接続中のメモリ）
+        mem_after, mem_peak = tracemalloc.get_traced_memory()
+        rss_after = _rss_mb()
+        coalesce_after = EhimeRetriever.coalesce_stats()
+        conv = _conversation_metrics(results)
+    tracemalloc.stop()
+
+    ok = [r for r in results if not r.error]
+    report = {
+        "users": users,
+        "concurrency": concurrency,
+        "refines_per_user": refines,
+        "wall_seconds": wall,
+        "completed_flows": len(ok),
+        "failed_flows": len(results) - len(ok),
+        "errors": sorted({r.error for r in results if r.error}),
+        "throughput_flows_per_min": len(ok) / wall * 60 if wall else 0.0,
+        "stages": {s: _percentiles([t for r in ok for t in r.timings[s]]) for s in STAGES},
+        "memory": {
+            "rss_growth_per_session_mb": (rss_after - rss_before) / max(1, users),
+            "rss_growth_mb": rss_after - rss_before,
+            "traced_growth_per_session_kb": (mem_after - mem_before) / max(1, users) / 1024 if trace_memory else None,
+            "traced_peak_mb": mem_peak / 1024 / 1024 if trace_memory else None,
+        },
+        "cpu": {
+            "mean_utilization": sum(cpu.samples) / len(cpu.samples) if cpu.samples else 0.0,
+            "max_utilization": max(cpu.samples, default=0.0),
+            "cores": os.cpu_count() or 1,
+        },
+        "coalesced_calls": coalesce_after["coalesced"] - coalesce_before["coalesced"],
+        "executed_calls": coalesce_after["executed"] - coalesce_before["executed"],
+        "conversation": conv,
+    }
+    return report
+
+
+def print_report(report: dict) -> None:
+    print(f"users={report['users']} concurrency={report['concurrency']} refines/user={report['refines_per_user']}")
+    print(
+        f"completed={report['completed_flows']} failed={report['failed_flows']} "
+        f"wall={report['wall_seconds']:.1f}s throughput={report['throughput_flows_per_min']:.1f} flows/min"
+    )
+    for err in report["errors"][:5]:
+        print(f"  error: {err}")
+    print(f"\n{'stage':<10}{'n':>6}{'mean':>9}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}  (sec)")
+    for stage, p in report["stages"].items():
+        if not p:
+            continue
+        print(
+            f"{stage:<10}{p['count']:>6}{p['mean']:>9.2f}{p['p50']:>9.2f}{p['p90']:>9.2f}"
+            f"{p['p95']:>9.2f}{p['p99']:>9.2f}{p['max']:>9.2f}"
+        )
+    mem, cpu = report["memory"], report["cpu"]
+    print(f"\nmemory: RSS +{mem['rss_growth_per_session_mb']:.2f} MB/session (total +{mem['rss_growth_mb']:.1f} MB)")
+    if mem["traced_growth_per_session_kb"] is not None:
+        print(
+            f"        Python heap +{mem['traced_growth_per_session_kb']:.0f} KB/session, "
+            f"peak {mem['traced_peak_mb']:.1f} MB (tracemalloc)"
+        )
+    print(f"cpu: mean {cpu['mean_utilization']:.0%} / max {cpu['max_utilization']:.0%} of {cpu['cores']} cores")
+    print(f"single-flight: executed {report['executed_calls']} / coalesced {report['coalesced_calls']}")
+    conv = report["conversation"]
+    if conv["prompt_tokens"]:
+        print(
+            f"refine cache: {conv['cached_tokens']:,} / {conv['prompt_tokens']:,} prompt tokens reused "
+            f"({conv['cached_tokens'] / conv['prompt_tokens']:.0%}), {conv['cache_builds']} cache builds"
+        )
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Multi-session load test for app.py with stubbed backends")
+    ap.add_argument("--users", type=int, default=10)
+    ap.add_argument("--concurrency", type=int, default=None, help="同時実行セッション数（既定: users）")
+    ap.add_argument("--refines", type=int, default=2)
+    ap.add_argument("--app", default=DEFAULT_APP)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--latency-scale", type=float, default=1.0, help="スタブ既定レイテンシの倍率（0 で遅延なし）")
+    ap.add_argument("--jitter", type=float, default=0.3)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--trace-memory", action="store_true", help="tracemalloc で Python ヒープ増分も計測（低速）")
+    ap.add_argument("--json", help="結果を JSON で保存するパス")
+    args = ap.parse_args()
+
+    cfg = StubConfig(jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    cfg.latency = {op: sec * args.latency_scale for op, sec in cfg.latency.items()}
+    report = run_load_test(
+        users=args.users,
+        concurrency=args.concurrency or args.users,
+        refines=args.refines,
+        app_path=args.app,
+        timeout=args.timeout,
+        stub_config=cfg,
+        trace_memory=args.trace_memory,
+    )
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
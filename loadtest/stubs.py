@@ -0,0 +1,215 @@
+from __future__ import annotations
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Dict
+from unittest import mock
+
+import numpy as np
+
+
+class StubAPIError(Exception):
+    """スタブが注入する疑似エラー（リトライ判定に乗るよう 503 を含める）。"""
+
+
+@dataclass
+class StubConfig:
+    # 操作ごとの平均レイテンシ（秒）
+    latency: Dict[str, float] = field(default_factory=lambda: {
+        "tavily.search": 0.8,
+        "tavily.extract": 0.3,
+        "gemini.embed": 0.15,
+        "gemini.generate": 1.5,
+        "gemini.cache": 0.2,
+    })
+    jitter: float = 0.3  # 平均 ±30% の一様ゆらぎ
+    error_rate: float = 0.0
+    seed: int = 0
+
+
+_config = StubConfig()
+_rng = random.Random(0)
+_rng_lock = threading.Lock()
+
+
+def configure(config: StubConfig) -> None:
+    global _config
+    _config = config
+    _rng.seed(config.seed)
+
+
+def _simulate(op: str) -> None:
+    with _rng_lock:
+        base = _config.latency.get(op, 0.0)
+        delay = base * _rng.uniform(1 - _config.jitter, 1 + _config.jitter)
+        fail = _rng.random() < _config.error_rate
+    time.sleep(max(0.0, delay))
+    if fail:
+        raise StubAPIError(f"503 UNAVAILABLE: injected failure in {op} (stub)")
+
+
+# --- Tavily ---
+_SPOTS = [
+    ("道後温泉本館", "松山市", "日本最古といわれる温泉。周辺には足湯や土産物の商店街があり、3月〜4月は桜も楽しめる。"),
+    ("松山城", "松山市", "ロープウェイで登る天守。城山からの展望が見どころで、歴史資料の展示もある。"),
+    ("しまなみ海道", "今治市", "レンタサイクルで島々を渡るサイクリングルート。大三島や伯方島に立ち寄れる。"),
+    ("内子の町並み", "内子町", "白壁の町並みと内子座。伝統工芸の体験工房が点在する。"),
+    ("宇和島城", "宇和島市", "現存天守の一つ。名物の鯛めしの食堂も近く、7月には牛鬼まつりが開かれる。"),
+    ("石鎚山", "西条市", "西日本最高峰。紅葉は10月〜11月が見頃で、ハイキングや登山に人気。"),
+    ("砥部焼の里", "砥部町", "砥部焼の窯元と美術館。絵付けのワークショップに参加できる。"),
+    ("佐田岬", "伊方町", "細長い半島の先端にある灯台。絶景の海岸線をドライブで巡れる。"),
+]
+
+
+def _page(query: str, i: int, domain: str) -> dict:
+    name, city, desc = _SPOTS[(int(hashlib.md5(query.encode()).hexdigest(), 16) + i) % len(_SPOTS)]
+    body = "\n\n".join(
+        f"## {name}（{city}）\n{desc} アクセスや所要時間、注意点などの実用情報を掲載。"
+        for _ in range(12)
+    )
+    return {
+        "url": f"https://{domain}/spot/{hashlib.md5(f'{query}-{i}'.encode()).hexdigest()[:10]}",
+        "title": f"{name} | {city}",
+        "raw_content": body,
+        "content": desc,
+    }
+
+
+class StubTavilyClient:
+    def __init__(self, api_key: str | None = None, **kwargs):
+        self.api_key = api_key
+
+    def search(self, query: str, max_results: int = 5, include_domains=None, **kwargs) -> dict:
+        _simulate("tavily.search")
+        domain = (include_domains or ["example.jp"])[0]
+        return {"query": query, "results": [_page(query, i, domain) for i in range(max_results)]}
+
+    def extract(self, url: str, **kwargs) -> dict:
+        _simulate("tavily.extract")
+        return {"text": _SPOTS[0][2]}
+
+
+# --- Gemini ---
+def _vector(text: str, dim: int) -> list:
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype("float32").tolist()
+
+
+def _tokens(text: str) -> int:
+    return -(-len(text) // 2)
+
+
+def _plan(trip_days: int, note: str = "") -> dict:
+    days = []
+    for d in range(1, trip_days + 1):
+        name, city, desc = _SPOTS[d % len(_SPOTS)]
+        days.append({
+            "day": d,
+            "theme": f"{city}めぐり",
+            "area": city,
+            "schedule": [
+                {"time": "10:00", "activity": "観光", "spot": name, "tip": desc[:30]},
+                {"time": "15:00", "activity": "休憩", "spot": "カフェ", "tip": "混雑時は予約推奨"},
+            ],
+            "notes": "スタブ応答",
+            "source_urls": [],
+        })
+    return {
+        "title": "愛媛 旅程プラン（スタブ）",
+        "summary": note,
+        "audience": "大人2",
+        "transport": "自家用車",
+        "days": days,
+        "sources": [],
+    }
+
+
+def _text_of(contents) -> str:
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, list):
+        return "\n".join(_text_of(c) for c in contents)
+    parts = getattr(contents, "parts", None) or []
+    return "\n".join(getattr(p, "text", "") or "" for p in parts)
+
+
+def _get(config, key: str, default=None):
+    if config is None:
+        return default
+    if isinstance(config, dict):
+        return config.get(key, default)
+    return getattr(config, key, default)
+
+
+class _StubCaches:
+    def __init__(self):
+        self._store: Dict[str, int] = {}
+
+    def create(self, model: str, config=None):
+        _simulate("gemini.cache")
+        text = (_get(config, "system_instruction") or "") + _text_of(_get(config, "contents") or [])
+        name = f"cachedContents/stub-{uuid.uuid4().hex[:8]}"
+        self._store[name] = _tokens(text)
+        return SimpleNamespace(name=name, usage_metadata=SimpleNamespace(total_token_count=self._store[name]))
+
+    def update(self, name: str, config=None):
+        _simulate("gemini.cache")
+        return SimpleNamespace(name=name)
+
+    def delete(self, name: str, config=None):
+        self._store.pop(name, None)
+
+
+class _StubModels:
+    def __init__(self, caches: _StubCaches):
+        self._caches = caches
+
+    def embed_content(self, model: str, contents, config=None):
+        _simulate("gemini.embed")
+        dim = _get(config, "output_dimensionality", 768) or 768
+        texts = contents if isinstance(contents, list) else [contents]
+        return SimpleNamespace(embeddings=[SimpleNamespace(values=_vector(_text_of(t), dim)) for t in texts])
+
+    def generate_content(self, model: str, contents, config=None):
+        _simulate("gemini.generate")
+        prompt = _text_of(contents)
+        cached = self._caches._store.get(_get(config, "cached_content") or "", 0)
+        if _get(config, "response_json_schema") is not None:
+            m = re.search(r"日数: (\d+)日", prompt)
+            req = re.search(r"# ユーザーからの修正依頼\n(.*?)\n", prompt)
+            text = json.dumps(
+                _plan(int(m.group(1)) if m else 2, req.group(1) if req else ""),
+                ensure_ascii=False,
+            )
+        else:
+            n = max(1, prompt.count("### CHUNK"))
+            text = json.dumps({"summaries": [f"要約 {i + 1}（スタブ）" for i in range(n)]}, ensure_ascii=False)
+        usage = SimpleNamespace(prompt_token_count=cached + _tokens(prompt), cached_content_token_count=cached)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+
+class StubGenaiClient:
+    def __init__(self, *args, **kwargs):
+        self.caches = _StubCaches()
+        self.models = _StubModels(self.caches)
+
+
+@contextmanager
+def installed(config: StubConfig | None = None):
+    """TavilyClient と genai.Client をスタブに差し替える（app.py / rag.retriever の両方に効く）。"""
+    configure(config or StubConfig())
+    import google.genai
+    import tavily
+    import rag.retriever
+
+    with mock.patch.object(tavily, "TavilyClient", StubTavilyClient), \
+         mock.patch.object(rag.retriever, "TavilyClient", StubTavilyClient), \
+         mock.patch.object(google.genai, "Client", StubGenaiClient):
+        yield
@@ -0,0 +1,307 @@
+from __future__ import annotations
+import json
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from google.genai import types
+
+from rag.prompts import (
+    ITINERARY_SCHEMA,
+    REFINE_SYSTEM,
+    build_refine_context,
+    build_refine_turn_prompt,
+)
+
+
+@dataclass
+class CacheHandle:
+    name: str
+    expire_at: float
+    token_count: int
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+
+
+# --- バックエンド: Gemini の cached content API ---
+class GeminiCacheBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model: str, system_instruction: str, contents: str, ttl_seconds: int) -> CacheHandle:
+        cache = self.client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                display_name="ehime-plan-refine",
+                system_instruction=system_instruction,
+                contents=[types.Content(role="user", parts=[types.Part(text=contents)])],
+                ttl=f"{int(ttl_seconds)}s",
+            ),
+        )
+        usage = getattr(cache, "usage_metadata", None)
+        return CacheHandle(
+            name=cache.name,
+            expire_at=time.time() + ttl_seconds,
+            token_count=getattr(usage, "total_token_count", 0) or 0,
+        )
+
+    def extend(self, handle: CacheHandle, ttl_seconds: int) -> CacheHandle:
+        self.client.caches.update(
+            name=handle.name,
+            config=types.UpdateCachedContentConfig(ttl=f"{int(ttl_seconds)}s"),
+        )
+        return CacheHandle(handle.name, time.time() + ttl_seconds, handle.token_count)
+
+    def delete(self, handle: CacheHandle) -> None:
+        self.client.caches.delete(name=handle.name)
+
+    def generate(
+        self,
+        model: str,
+        contents: str,
+        cached_content: Optional[str] = None,
+        system_instruction: Optional[str] = None,
+    ) -> GenerationResult:
+        config = {
+            "response_mime_type": "application/json",
+            "response_json_schema": ITINERARY_SCHEMA,
+        }
+        # cached_content 利用時は system_instruction をキャッシュ側に持たせる（併用不可）
+        if cached_content:
+            config["cached_content"] = cached_content
+        elif system_instruction:
+            config["system_instruction"] = system_instruction
+        resp = self.client.models.generate_content(model=model, contents=contents, config=config)
+        usage = getattr(resp, "usage_metadata", None)
+        return GenerationResult(
+            text=resp.text,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            cached_tokens=getattr(usage, "cached_content_token_count", 0) or 0,
+        )
+
+
+# --- バックエンド: ネットワーク不要のローカル実装（動作確認・負荷試験用） ---
+def _echo_plan(full_prompt: str) -> str:
+    # 差分内の「現在の旅行プラン」をそのまま返し、summary に依頼文を残す
+    blocks = re.findall(r"```json\n(.*?)\n```", full_prompt, flags=re.S)
+    plan = json.loads(blocks[-1]) if blocks else {}
+    m = re.search(r"# ユーザーからの修正依頼\n(.*?)\n\n", full_prompt, flags=re.S)
+    if m:
+        plan["summary"] = f"{plan.get('summary', '')}（修正: {m.group(1).strip()}）".strip()
+    return json.dumps(plan, ensure_ascii=False)
+
+
+class FakeCacheBackend:
+    """
+    Gemini の cached content と同じ振る舞い（TTL 失効・削除・トークン計上）を模したローカル実装。
+    responder には「システム指示 + キャッシュ内容 + 差分」の全文が渡る。
+    """
+
+    def __init__(
+        self,
+        responder: Optional[Callable[[str], str]] = None,
+        chars_per_token: int = 2,
+        min_cache_tokens: int = 0,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.responder = responder or _echo_plan
+        self.chars_per_token = chars_per_token
+        self.min_cache_tokens = min_cache_tokens
+        self.clock = clock
+        self.caches: Dict[str, Tuple[str, float, int]] = {}
+        self.calls: List[str] = []
+
+    def _tokens(self, text: str) -> int:
+        return -(-len(text) // self.chars_per_token)
+
+    def _lookup(self, name: str) -> Tuple[str, float, int]:
+        entry = self.caches.get(name)
+        if entry is None or entry[1] <= self.clock():
+            self.caches.pop(name, None)
+            raise LookupError(f"404 NOT_FOUND: cached content {name} not found or expired")
+        return entry
+
+    def create(self, model: str, system_instruction: str, contents: str, ttl_seconds: int) -> CacheHandle:
+        self.calls.append("create")
+        text = system_instruction + "\n" + contents
+        tokens = self._tokens(text)
+        if tokens < self.min_cache_tokens:
+            raise ValueError(f"400 INVALID_ARGUMENT: cached content is too small ({tokens} tokens)")
+        name = f"cachedContents/fake-{uuid.uuid4().hex[:8]}"
+        expire_at = self.clock() + ttl_seconds
+        self.caches[name] = (text, expire_at, tokens)
+        return CacheHandle(name, expire_at, tokens)
+
+    def extend(self, handle: CacheHandle, ttl_seconds: int) -> CacheHandle:
+        self.calls.append("extend")
+        text, _, tokens = self._lookup(handle.name)
+        expire_at = self.clock() + ttl_seconds
+        self.caches[handle.name] = (text, expire_at, tokens)
+        return CacheHandle(handle.name, expire_at, tokens)
+
+    def delete(self, handle: CacheHandle) -> None:
+        self.calls.append("delete")
+        self.caches.pop(handle.name, None)
+
+    def generate(
+        self,
+        model: str,
+        contents: str,
+        cached_content: Optional[str] = None,
+        system_instruction: Optional[str] = None,
+    ) -> GenerationResult:
+        self.calls.append("generate")
+        cached_text, cached_tokens = "", 0
+        if cached_content:
+            cached_text, _, cached_tokens = self._lookup(cached_content)
+            cached_text += "\n"
+        elif system_instruction:
+            contents = system_instruction + "\n" + contents
+        return GenerationResult(
+            text=self.responder(cached_text + contents),
+            prompt_tokens=cached_tokens + self._tokens(contents),
+            cached_tokens=cached_tokens,
+        )
+
+
+# --- 会話エンジン ---
+def _is_cache_gone(e: Exception) -> bool:
+    # 404 NOT_FOUND（失効・削除済み）。google-genai の APIError は code / status を持つ
+    return getattr(e, "code", None) == 404 or "NOT_FOUND" in str(e) or "not found" in str(e).lower()
+
+
+def _is_uncacheable(e: Exception) -> bool:
+    # 400 INVALID_ARGUMENT（最小トークン数未満など）。再試行しても通らない
+    return getattr(e, "code", None) == 400 or "INVALID_ARGUMENT" in str(e)
+
+
+@dataclass
+class ConversationMetrics:
+    turns: int = 0
+    cache_hit_turns: int = 0
+    cache_builds: int = 0
+    cache_extends: int = 0
+    fallback_turns: int = 0
+    prompt_tokens: int = 0
+    # 既存キャッシュに当たったターンの分だけ数える（作成直後のターンは再利用ではない）
+    cached_tokens: int = 0
+
+    @property
+    def reuse_ratio(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+
+@dataclass
+class PlanConversation:
+    """
+    プランのマルチターン修正。ガードレール・スキーマ・参考要点・出典（プランごとに不変）を
+    cached content に1回だけ載せ、各ターンは現在のプラン・修正履歴・依頼を差分として送る。
+    TTL 切れが近ければ延長し、失効していれば作り直す。
+    """
+
+    backend: object
+    plan: dict
+    context: List[str] = field(default_factory=list)
+    sources: List[dict] = field(default_factory=list)
+    model: str = "gemini-2.5-flash-lite"
+    ttl_seconds: int = 900
+    refresh_margin: int = 60
+    history: List[str] = field(default_factory=list)
+    metrics: ConversationMetrics = field(default_factory=ConversationMetrics)
+    clock: Callable[[], float] = time.time
+    _cache: Optional[CacheHandle] = field(default=None, repr=False)
+    _cache_unavailable: bool = field(default=False, repr=False)
+
+    def _cached_text(self) -> str:
+        return build_refine_context(self.context, self.sources)
+
+    def _drop_cache(self) -> None:
+        if self._cache is not None:
+            try:
+                self.backend.delete(self._cache)
+            except Exception as e:
+                print(f"Failed to delete cached content: {e}")
+        self._cache = None
+
+    def _ensure_cache(self) -> Tuple[Optional[CacheHandle], bool]:
+        """(キャッシュ, 既存キャッシュの再利用か) を返す。"""
+        if self._cache_unavailable:
+            return None, False
+        now = self.clock()
+        if self._cache is not None:
+            if now < self._cache.expire_at - self.refresh_margin:
+                return self._cache, True
+            if now < self._cache.expire_at:
+                try:
+                    self._cache = self.backend.extend(self._cache, self.ttl_seconds)
+                    self.metrics.cache_extends += 1
+                    return self._cache, True
+                except Exception as e:
+                    if not _is_cache_gone(e):
+                        # 一時的な失敗: 失効前なのでそのまま使い、延長は次のターンで再試行
+                        print(f"Failed to extend cached content: {e}")
+                        return self._cache, True
+            # サーバ側で既に失効・削除済みなので delete は不要
+            self._cache = None
+        try:
+            self._cache = self.backend.create(self.model, REFINE_SYSTEM, self._cached_text(), self.ttl_seconds)
+            self.metrics.cache_builds += 1
+        except Exception as e:
+            print(f"Context cache unavailable, sending full prompt: {e}")
+            if _is_uncacheable(e):
+                # 最小トークン数未満などでキャッシュできない内容 → この会話では以後も全文送信
+                self._cache_unavailable = True
+            # 429 / 503 などの一時的な失敗は、このターンだけ全文送信して次のターンで再作成する
+        return self._cache, False
+
+    def _generate(self, delta: str) -> Tuple[GenerationResult, bool]:
+        for _ in range(2):
+            cache, reused = self._ensure_cache()
+            if cache is None:
+                break
+            try:
+                return self.backend.generate(self.model, delta, cached_content=cache.name), reused
+            except Exception as e:
+                if not _is_cache_gone(e):
+                    # 一時的な失敗ではキャッシュを捨てず（課金中のまま孤立させない）全文送信で代替
+                    print(f"Cached generation failed, sending full prompt: {e}")
+                    break
+                # サーバ側で失効・削除済み → 1回だけ作り直して再送
+                print(f"Cached content expired, rebuilding cache: {e}")
+                self._cache = None
+        self.metrics.fallback_turns += 1
+        res = self.backend.generate(
+            self.model, self._cached_text() + "\n" + delta, system_instruction=REFINE_SYSTEM,
+        )
+        return res, False
+
+    def refine(self, user_request: str) -> Tuple[Optional[dict], str]:
+        """修正依頼を1ターン処理する。(新しいプラン or None, 生の応答テキスト) を返す。"""
+        res, reused = self._generate(build_refine_turn_prompt(self.plan, user_request, self.history))
+        self.metrics.turns += 1
+        self.metrics.prompt_tokens += res.prompt_tokens
+        if reused:
+            self.metrics.cache_hit_turns += 1
+            self.metrics.cached_tokens += res.cached_tokens
+        try:
+            new_plan = json.loads(res.text)
+        except json.JSONDecodeError:
+            return None, res.text
+        self.update_plan(new_plan, user_request)
+        return new_plan, res.text
+
+    def update_plan(self, plan: dict, user_request: Optional[str] = None) -> None:
+        # キャッシュは参考要点側だけなので、プランが変わっても作り直さない
+        self.plan = plan
+        if user_request:
+            self.history.append(user_request)
+
+    def close(self) -> None:
+        self._drop_cache()
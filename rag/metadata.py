@@ -0,0 +1,170 @@
+from __future__ import annotations
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Sequence
+
+# --- 地名ガゼッティア（市町・主要観光地 → 三地域） ---
+AREA_GAZETTEER: Dict[str, List[str]] = {
+    "中予": [
+        "松山", "道後", "伊予市", "東温", "久万高原", "松前町", "砥部",
+        "興居島", "中島", "双海", "下灘", "三津浜", "梅津寺",
+    ],
+    "東予": [
+        "今治", "西条", "新居浜", "四国中央", "上島町", "しまなみ", "大三島",
+        "伯方島", "大島", "石鎚", "別子", "川之江", "伊予三島", "小松", "丹原", "弓削",
+    ],
+    "南予": [
+        "大洲", "内子", "宇和島", "八幡浜", "西予", "伊方", "佐田岬", "鬼北",
+        "松野", "愛南", "宇和町", "三瓶", "肱川", "滑床", "遊子", "日振島", "卯之町",
+    ],
+}
+
+# --- テーマ（サイドバーの「関心テーマ」と同じラベル） ---
+THEME_KEYWORDS: Dict[str, List[str]] = {
+    "温泉": ["温泉", "湯治", "足湯", "入浴", "道後", "鈍川", "本谷"],
+    "城・歴史": ["城", "歴史", "史跡", "寺", "神社", "遍路", "札所", "町並み", "文化財", "資料館"],
+    "サイクリング": ["サイクリング", "自転車", "レンタサイクル", "しまなみ海道", "ロードバイク"],
+    "自然景観": ["絶景", "景観", "展望", "渓谷", "滝", "海岸", "夕日", "石鎚山", "四国カルスト", "自然"],
+    "島めぐり": ["島めぐり", "島々", "離島", "フェリー", "渡船", "高速船", "興居島", "大三島", "日振島"],
+    "グルメ": ["グルメ", "料理", "鯛めし", "じゃこ天", "みかん", "焼豚玉子飯", "食堂", "カフェ", "ランチ", "名物"],
+    "アート": ["美術館", "アート", "博物館", "ギャラリー", "砥部焼", "工芸"],
+    "祭り・イベント": ["祭", "まつり", "イベント", "花火", "フェスティバル", "例大祭"],
+    "体験・アクティビティ": ["体験", "アクティビティ", "カヌー", "SUP", "釣り", "工房", "ワークショップ", "ハイキング", "登山"],
+}
+
+# --- 季節・行事 → 該当月 ---
+# 単漢字（梅・桜・藤・雪・蛍）は地名や商品名（梅津寺・桜井・佐藤・雪見大福・蛍光）に
+# 含まれるため、季節を表す複合語だけを登録する
+SEASON_KEYWORDS: Dict[str, List[int]] = {
+    "梅の花": [2, 3], "梅林": [2, 3], "観梅": [2, 3], "梅まつり": [2, 3], "菜の花": [2, 3],
+    "桜の開花": [3, 4], "桜が見頃": [3, 4], "桜並木": [3, 4], "夜桜": [3, 4], "桜まつり": [3, 4],
+    "花見": [3, 4], "藤の花": [4, 5], "藤棚": [4, 5], "藤まつり": [4, 5],
+    "新緑": [5], "あじさい": [6], "紫陽花": [6], "ホタル": [6], "蛍狩り": [6], "蛍の乱舞": [6],
+    "鵜飼": [6, 7, 8, 9], "海水浴": [7, 8], "花火": [7, 8], "夏祭り": [7, 8],
+    "牛鬼まつり": [7], "秋祭り": [10], "西条まつり": [10], "太鼓祭り": [10],
+    "紅葉": [11], "みかん狩り": [10, 11, 12], "肱川あらし": [10, 11, 12, 1, 2, 3],
+    "積雪": [12, 1, 2], "雪景色": [12, 1, 2], "雪化粧": [12, 1, 2], "スキー": [12, 1, 2],
+}
+
+# 「4月上旬〜5月」のような月の範囲。「2023年4月」「12月29日」のような年・日付付きは対象外
+_MONTH_RANGE = re.compile(
+    r"(?<![\d年])(\d{1,2})月(?!\d)(?:上旬|中旬|下旬|頃|末)?\s*[〜~\-]\s*(\d{1,2})月(?!\d)"
+)
+# 範囲の前後にこれらがあるときだけ季節・行事の時期とみなす（休業日や更新日を拾わない）。
+# 月の範囲と隣接する場合に限るので、単漢字の季節語もここでは手掛かりに使う
+_SEASON_CUES = list(SEASON_KEYWORDS) + [
+    "梅", "桜", "藤", "蛍", "雪", "見頃", "開催", "祭", "まつり", "シーズン", "旬", "開花", "イベント",
+]
+_CLOSURE_CUES = ["休業", "休館", "休園", "休み", "定休", "更新", "閉鎖", "運休"]
+_CUE_WINDOW = 15
+
+
+def _normalize(text: str) -> str:
+    # 全角数字・記号を半角へ
+    return unicodedata.normalize("NFKC", text or "")
+
+
+def _month_span(start: int, end: int) -> List[int]:
+    # 11月〜2月 のような年跨ぎにも対応
+    if not (1 <= start <= 12 and 1 <= end <= 12):
+        return []
+    months, m = [start], start
+    while m != end:
+        m = m % 12 + 1
+        months.append(m)
+    return months
+
+
+def resolve_areas(text: str) -> List[str]:
+    """地名ガゼッティアに一致した地域を、ヒット数の多い順に返す。"""
+    text = _normalize(text)
+    counts = {
+        area: sum(text.count(name) for name in names)
+        for area, names in AREA_GAZETTEER.items()
+    }
+    for area in AREA_GAZETTEER:
+        # 「中予」「東予」「南予」の直接表記
+        counts[area] += text.count(area)
+    return [a for a, n in sorted(counts.items(), key=lambda x: -x[1]) if n > 0]
+
+
+def detect_themes(text: str) -> List[str]:
+    text = _normalize(text)
+    return [t for t, words in THEME_KEYWORDS.items() if any(w in text for w in words)]
+
+
+def detect_months(text: str) -> List[int]:
+    """季節語・行事名と、それに隣接する月の範囲から該当月を推定する（単独の「N月」は使わない）。"""
+    text = _normalize(text)
+    months = set()
+    for m in _MONTH_RANGE.finditer(text):
+        window = text[max(0, m.start() - _CUE_WINDOW) : m.end() + _CUE_WINDOW]
+        if any(c in window for c in _CLOSURE_CUES) or not any(c in window for c in _SEASON_CUES):
+            continue
+        months.update(_month_span(int(m.group(1)), int(m.group(2))))
+    for word, ms in SEASON_KEYWORDS.items():
+        if word in text:
+            months.update(ms)
+    return sorted(months)
+
+
+def tag_chunk(text: str, title: str = "") -> dict:
+    """チャンクに構造化メタデータ（areas / themes / months）を付与する。"""
+    full = f"{title}\n{text}"
+    return {
+        "areas": resolve_areas(full),
+        "themes": detect_themes(full),
+        "months": detect_months(text),
+    }
+
+
+@dataclass
+class ChunkFilter:
+    """
+    類似検索の前に候補チャンクを絞り込む条件。各条件は OR、条件同士は AND。
+    months はタグなし（通年）のチャンクも通す。
+    """
+
+    areas: List[str] = field(default_factory=list)
+    themes: List[str] = field(default_factory=list)
+    months: List[int] = field(default_factory=list)
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.areas or self.themes or self.months)
+
+    def matches(self, tags: dict) -> bool:
+        if self.areas and not set(self.areas) & set(tags.get("areas", [])):
+            return False
+        if self.themes and not set(self.themes) & set(tags.get("themes", [])):
+            return False
+        chunk_months = tags.get("months", [])
+        if self.months and chunk_months and not set(self.months) & set(chunk_months):
+            return False
+        return True
+
+
+def filter_from_conditions(
+    start_area: str = "",
+    interests: Sequence[str] = (),
+    start_date: Optional[date | str] = None,
+    trip_days: int = 1,
+) -> ChunkFilter:
+    """サイドバーの入力（エリア・関心テーマ・開始日）から ChunkFilter を作る。"""
+    areas: List[str] = []
+    if start_area and start_area != "指定なし":
+        # 「中予(松山・道後)」のような選択肢も自由記述も、ガゼッティアで解決する
+        areas = resolve_areas(start_area)[:1]
+
+    months: List[int] = []
+    if start_date:
+        d0 = date.fromisoformat(start_date) if isinstance(start_date, str) else start_date
+        for i in range(max(1, int(trip_days))):
+            m = (d0 + timedelta(days=i)).month
+            if m not in months:
+                months.append(m)
+
+    themes = [t for t in interests if t in THEME_KEYWORDS]
+    return ChunkFilter(areas=areas, themes=themes, months=months)
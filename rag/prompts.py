@@ -126,24 +126,45 @@ def build_plan_prompt(
         context=ctx,
     )
 
-def build_refine_plan_prompt(existing_plan: dict, user_request: str) -> str:
+
+REFINE_SYSTEM = SYSTEM_GUARDRAILS + (
+    "あなたは既存の旅行プランを、ユーザーの修正依頼に沿って更新する。\n"
+    "- 出力は必ず旅程JSONスキーマに準拠した JSON のみ。\n"
+    "- 元のプランの構造を維持し、必要な箇所だけを修正する。\n"
+    "- 追加・変更するスポットは【参考要点】に根拠があるものを優先し、source_urls を更新する。\n"
+    "- 修正が難しい場合でも、何らかの形で依頼に応えようと試みる。\n"
+)
+
+def build_refine_context(context: list[str], sources: list[dict]) -> str:
     """
-    既存のプランとユーザーの修正依頼から、プラン修正用のプロンプトを生成する。
+    マルチターン修正でキャッシュする固定部分（スキーマ・参考要点・出典）を組み立てる。
+    プランごとに1回だけキャッシュし、現在のプランと修正依頼は build_refine_turn_prompt で毎ターン送る。
     """
-    plan_str = json.dumps(existing_plan, indent=2, ensure_ascii=False)
-    
-    return f'''
-あなたは優秀な旅行プランナーです。
+    schema_str = json.dumps(ITINERARY_SCHEMA, ensure_ascii=False)
+    ctx = "\n\n".join(context) if context else "（なし）"
+    src = "\n".join(f"- {s.get('title', '')} | {s.get('url', '')}" for s in sources) or "（なし）"
+
+    return f'''# 旅程JSONスキーマ
+```json
+{schema_str}
+```
+
+【参考要点】
+{ctx}
+
+【出典】
+{src}
+'''
 
-以下の既存の旅行プランが提示されています。
-ユーザーからの修正依頼を基に、このプランを更新してください。
+def build_refine_turn_prompt(plan: dict, user_request: str, history: list[str] | None = None) -> str:
+    """キャッシュ済みコンテキストに続けて送る、1ターン分の差分（現在のプラン・修正履歴・依頼）。"""
+    plan_str = json.dumps(plan, indent=2, ensure_ascii=False)
+    past = "\n".join(f"- {h}" for h in (history or [])) or "（なし）"
 
-制約:
-- 必ず `ITINERARY_SCHEMA` に準拠したJSON形式で出力してください。
-- 元のプランの構造を維持し、必要な箇所だけを修正してください。
-- 修正が難しい場合でも、何らかの形で依頼に応えようと試みてください。
+    return f'''# これまでの修正依頼（反映済み）
+{past}
 
-# 既存の旅行プラン (JSON)
+# 現在の旅行プラン (JSON)
 ```json
 {plan_str}
 ```
@@ -4,7 +4,7 @@ import time
 import html
 import hashlib
 import json
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
 
 import numpy as np
 from pydantic import BaseModel, Field
@@ -14,13 +14,18 @@ from bs4 import BeautifulSoup
 from google import genai
 from google.genai import types
 
-# --- 切替: FAISS を使わず Numpy 類似度のみでも動かせる ---
+from rag.metadata import ChunkFilter, tag_chunk
+from rag.singleflight import SingleFlight, fingerprint
+from rag.vector_index import build_index
+
+# --- 切替: FAISS を使わず Numpy 類似度のみでも動かせる（faiss 未導入時は自動で NumPy） ---
 USE_FAISS = True
-try:
-    if USE_FAISS:
-        import faiss  # type: ignore
-except Exception:
-    USE_FAISS = False
+
+# 進捗コールバック: (ステージ名, 0.0〜1.0)。ジョブ実行時のキャンセル検知にも使う
+ProgressFn = Callable[[str, float], None]
+
+def _no_progress(stage: str, progress: float) -> None:
+    pass
 
 class RetrievalItem(BaseModel):
     title: str
@@ -30,17 +35,31 @@ class RetrievalItem(BaseModel):
     content_chars: int
 
 class EhimeRetriever:
+    # セッション（インスタンス）をまたいで同一リクエストを1回にまとめる
+    _flight = SingleFlight()
+
     def __init__(self, api_key: str):
         self.client = TavilyClient(api_key)
         self.gclient = genai.Client()  # GEMINI_API_KEY は環境/Secrets から
 
+    @classmethod
+    def coalesce_stats(cls) -> dict:
+        """single-flight の集計（calls / executed / coalesced / inflight）。"""
+        return cls._flight.stats()
+
+    def _search(self, **kwargs) -> dict:
+        key = fingerprint("tavily.search", kwargs)
+        return self._flight.do(key, lambda: self.client.search(**kwargs))
+
     # --- 1) 検索→抽出→要約/クリーニング ---
     def search_and_prepare(
         self,
         query: str,
         max_results: int = 8,
         add_web_search: bool = False,
+        progress: Optional[ProgressFn] = None,
     ) -> List[RetrievalItem]:
+        progress = progress or _no_progress
         items: List[RetrievalItem] = []
         seen_urls = set()
 
@@ -52,8 +71,9 @@ class EhimeRetriever:
             iyokan_results_count = max_results
             web_results_count = 0
 
-        def _process_results(results, is_iyokan: bool):
-            for r in results:
+        def _process_results(results, is_iyokan: bool, start: float, end: float):
+            for n, r in enumerate(results):
+                progress("ページ抽出・整形", start + (end - start) * n / max(1, len(results)))
                 url = r.get("url", "")
                 if not url or url in seen_urls:
                     continue
@@ -83,25 +103,27 @@ class EhimeRetriever:
 
         # 1. いよ観ネットを検索
         if iyokan_results_count > 0:
+            progress("いよ観ネットを検索", 0.05)
             try:
-                resp_iyokan = self.client.search(
+                resp_iyokan = self._search(
                     query=query, search_depth="advanced", include_raw_content="markdown",
                     include_answer=False, include_domains=["iyokannet.jp"],
                     max_results=iyokan_results_count, chunks_per_source=3, timeout=120
                 )
-                _process_results(resp_iyokan.get("results", []), is_iyokan=True)
+                _process_results(resp_iyokan.get("results", []), is_iyokan=True, start=0.3, end=0.5 if web_results_count else 1.0)
             except Exception as e:
                 print(f"Error searching iyokannet.jp: {e}")
 
         # 2. ウェブ全体を検索 (追加が有効な場合)
         if web_results_count > 0:
+            progress("ウェブ全体を検索", 0.5)
             try:
-                resp_web = self.client.search(
+                resp_web = self._search(
                     query=query, search_depth="advanced", include_raw_content="markdown",
                     include_answer=False, max_results=web_results_count, 
                     chunks_per_source=3, timeout=120
                 )
-                _process_results(resp_web.get("results", []), is_iyokan=False)
+                _process_results(resp_web.get("results", []), is_iyokan=False, start=0.75, end=1.0)
             except Exception as e:
                 print(f"Error searching web: {e}")
 
@@ -121,6 +143,12 @@ class EhimeRetriever:
 
     # --- 2) 埋め込みユーティリティ ---
     def _embed(self, texts: List[str], task_type: str, dim: int = 768) -> np.ndarray:
+        key = fingerprint("embed", "gemini-embedding-001", task_type, dim, texts)
+        X = self._flight.do(key, lambda: self._embed_batches(texts, task_type, dim))
+        # 結果は待機者間で共有されるため、呼び出し側の in-place 正規化に備えてコピーを返す
+        return X.copy()
+
+    def _embed_batches(self, texts: List[str], task_type: str, dim: int) -> np.ndarray:
         all_vecs = []
         # Process in batches to respect API limits (e.g., 100 texts per batch)
         # and add a delay to respect rate limits (e.g., 60 requests per minute)
@@ -161,26 +189,21 @@ class EhimeRetriever:
     # --- 3) ベクトル化 → 検索 ---
     def _build_index(self, chunks: List[str]):
         X = self._embed(chunks, task_type="RETRIEVAL_DOCUMENT")
-        if USE_FAISS:
-            index = faiss.IndexFlatIP(X.shape[1])
-            faiss.normalize_L2(X)
-            index.add(X)
-            return index, X
-        # 代替: 生行列を返す
-        return None, X
-
-    def _search_index(self, index, X: np.ndarray, q: np.ndarray, topk: int = 8) -> Tuple[List[int], List[float]]:
-        if USE_FAISS and index is not None:
-            faiss.normalize_L2(q)
-            D, I = index.search(q, topk)
-            return I[0].tolist(), D[0].tolist()
-        # 代替: NumPy コサイン類似度
-        # 正規化
-        Xn = X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-9)
-        qn = q / (np.linalg.norm(q, axis=1, keepdims=True) + 1e-9)
-        sims = Xn @ qn.T
-        order = np.argsort(-sims[:, 0])[:topk]
-        return order.tolist(), sims[order, 0].tolist()
+        if X.shape[0] == 0:
+            return None
+        return build_index(X, use_faiss=USE_FAISS)
+
+    def _search_index(
+        self,
+        index,
+        q: np.ndarray,
+        topk: int = 8,
+        mask: Optional[np.ndarray] = None,
+    ) -> Tuple[List[int], List[float]]:
+        # mask: 検索対象にするチャンクの真偽配列（類似度計算の前に絞り込む）
+        D, I = index.search(q, topk, mask=mask)
+        keep = I[0] >= 0  # 候補が topk 未満のときは -1 で埋められる
+        return I[0][keep].tolist(), D[0][keep].tolist()
 
     def _chunk(self, text: str, size: int = 800, overlap: int = 120) -> List[str]:
         # 文字ベース簡易チャンク（和文前提）
@@ -191,23 +214,44 @@ class EhimeRetriever:
             i += size - overlap
         return chunks
 
-    def retrieve_for_plan(self, items: List[RetrievalItem], user_query: str, k: int = 8):
-        chunk_texts, chunk_meta = [], []
+    def retrieve_for_plan(
+        self,
+        items: List[RetrievalItem],
+        user_query: str,
+        k: int = 8,
+        progress: Optional[ProgressFn] = None,
+        chunk_filter: Optional[ChunkFilter] = None,
+    ):
+        progress = progress or _no_progress
+        chunk_texts, chunk_meta, chunk_tags = [], [], []
         for it in items:
             chunks = self._chunk(it.content)
             for ch in chunks:
                 chunk_texts.append(ch)
                 chunk_meta.append({"title": it.title, "url": it.url, "site": it.site})
+                # エリア・テーマ・季節のタグ（事前絞り込み用）
+                chunk_tags.append(tag_chunk(ch, it.title))
     
         if not chunk_texts:
             return [], []
     
-        index, X = self._build_index(chunk_texts)
-        if X.shape[0] == 0:
+        progress("チャンクを埋め込み", 0.1)
+        index = self._build_index(chunk_texts)
+        if index is None:
             return [], []
     
+        progress("類似チャンクを検索", 0.5)
         q = self._embed([user_query], task_type="RETRIEVAL_QUERY")
-        ids, scores = self._search_index(index, X, q, topk=k)
+        mask = None
+        if chunk_filter is not None and not chunk_filter.is_empty:
+            mask = np.array([chunk_filter.matches(t) for t in chunk_tags], dtype=bool)
+            if not mask.any():
+                mask = None
+        ids, scores = self._search_index(index, q, topk=k, mask=mask)
+        if mask is not None and len(ids) < k:
+            # 条件に合うチャンクが少なければ、条件外の上位で補う
+            more, _ = self._search_index(index, q, topk=k)
+            ids += [i for i in more if i not in ids][: k - len(ids)]
     
         # 1) まず「URLあたり1チャンク」に絞る（ここが効く）
         picked = []
@@ -230,6 +274,7 @@ class EhimeRetriever:
             return [], []
     
         # 2) 要約をまとめて1回だけ実行
+        progress("要点を要約", 0.6)
         texts_to_sum = [chunk_texts[idx] for idx in picked]
         print(f"Summarizing {len(texts_to_sum)} chunks in one request...")
         summaries = self._summarize_for_context_batch(texts_to_sum)
@@ -262,6 +307,10 @@ class EhimeRetriever:
         複数チャンクを1回の generate_content で要約して返す（順序維持）。
         返り値は texts と同じ長さの summary リスト。
         """
+        key = fingerprint("summarize_batch", "gemini-2.5-flash-lite", texts)
+        return list(self._flight.do(key, lambda: self._summarize_batch_call(texts)))
+
+    def _summarize_batch_call(self, texts: List[str]) -> List[str]:
         # JSONで返させる（順序通りの配列）
         joined = "\n\n".join(
             [f"### CHUNK {i+1}\n{t[:4000]}" for i, t in enumerate(texts)]
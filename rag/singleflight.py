@@ -0,0 +1,108 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+def fingerprint(*parts: Any) -> str:
+    """
+    リクエスト内容から決定的なキーを作る（同一入力 → 同一キー）。
+    JSON化できない値は repr で代用する。
+    """
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=repr)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _LeaderAbandoned(Exception):
+    """leader がキャンセル等で結果を出さずに抜けたことを待機側へ知らせる（待機側は再実行する）。"""
+
+
+class SingleFlight:
+    """
+    同一キーの処理が実行中なら、後続の呼び出しはその結果（または例外）を共有する。
+    スレッド（do）と asyncio（do_async）のどちらから呼んでも同じ in-flight を共有できる。
+    leader がキャンセル（CancelledError など Exception 以外）で抜けた場合、その例外は
+    leader だけに送出し、待機側は改めて join して新しい leader が実行する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+        self._calls = 0
+        self._executed = 0
+        self._coalesced = 0
+
+    def _join(self, key: str, retry: bool = False):
+        # (future, is_leader) を返す。leader だけが実処理を行う
+        with self._lock:
+            if not retry:
+                self._calls += 1
+            fut = self._inflight.get(key)
+            if fut is not None:
+                if not retry:
+                    self._coalesced += 1
+                return fut, False
+            fut = Future()
+            self._inflight[key] = fut
+            self._executed += 1
+            if retry:
+                # 待機側からの引き継ぎ: 1回の呼び出しとして集計し直す
+                self._coalesced -= 1
+            return fut, True
+
+    def _finish(self, key: str, fut: Future, result: Any = None, error: BaseException | None = None):
+        # 完了後に来た呼び出しは新しく実行させるため、結果を配る前にキーを外す
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is None:
+            fut.set_result(result)
+        elif isinstance(error, Exception):
+            fut.set_exception(error)
+        else:
+            # キャンセル・割り込みは leader 固有の事情なので待機側には配らない
+            fut.set_exception(_LeaderAbandoned())
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        fut, leader = self._join(key)
+        while not leader:
+            try:
+                return fut.result()
+            except _LeaderAbandoned:
+                fut, leader = self._join(key, retry=True)
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, fut, error=e)
+            raise
+        self._finish(key, fut, result=result)
+        return result
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        fut, leader = self._join(key)
+        while not leader:
+            try:
+                # shield: 待機側自身のキャンセルで共有 Future をキャンセルしない
+                return await asyncio.shield(asyncio.wrap_future(fut))
+            except _LeaderAbandoned:
+                fut, leader = self._join(key, retry=True)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._finish(key, fut, error=e)
+            raise
+        self._finish(key, fut, result=result)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "calls": self._calls,
+                "executed": self._executed,
+                "coalesced": self._coalesced,
+                "inflight": len(self._inflight),
+            }
@@ -0,0 +1,133 @@
+from __future__ import annotations
+from typing import Optional, Tuple
+
+import numpy as np
+
+try:
+    import faiss  # type: ignore
+except Exception:
+    faiss = None
+
+
+def _normalize_rows(X: np.ndarray) -> np.ndarray:
+    # 入力は変更せず、float32 の新しい配列を返す
+    X = np.asarray(X, dtype=np.float32)
+    return X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-9)
+
+
+def _as_queries(Q: np.ndarray) -> np.ndarray:
+    Q = np.asarray(Q, dtype=np.float32)
+    return Q.reshape(1, -1) if Q.ndim == 1 else Q
+
+
+class NumpyIndex:
+    """
+    内積（コサイン）検索の NumPy 実装。行列は構築時に1回だけ正規化し、
+    C連続の float32 / float16 で保持する。検索は argpartition による top-k、
+    複数クエリの一括処理、行ブロック単位の評価（np.memmap 上の大規模行列向け）に対応。
+    """
+
+    def __init__(
+        self,
+        X: np.ndarray,
+        dtype: str = "float32",
+        chunk_rows: Optional[int] = None,
+        memmap_path: Optional[str] = None,
+    ):
+        X = np.asarray(X)
+        n, d = X.shape
+        self.dtype = np.dtype(dtype)
+        # float16 は検索時にブロック単位で float32 へ戻す（全行列のコピーを作らない）
+        self.chunk_rows = chunk_rows or (8192 if self.dtype != np.float32 else None)
+        if memmap_path:
+            # メモリに載らない規模: 正規化済み行列をディスクへブロックごとに書き出す
+            step = self.chunk_rows or 65536
+            mm = np.memmap(memmap_path, dtype=self.dtype, mode="w+", shape=(n, d))
+            for s in range(0, n, step):
+                mm[s : s + step] = _normalize_rows(X[s : s + step])
+            mm.flush()
+            del mm
+            self.X = np.memmap(memmap_path, dtype=self.dtype, mode="r", shape=(n, d))
+            self.chunk_rows = step
+        else:
+            self.X = np.ascontiguousarray(_normalize_rows(X), dtype=self.dtype)
+
+    @classmethod
+    def open_memmap(cls, path: str, shape: Tuple[int, int], dtype: str = "float32", chunk_rows: int = 65536) -> "NumpyIndex":
+        """正規化済みで保存された memmap 行列をそのまま開く（再正規化しない）。"""
+        index = cls.__new__(cls)
+        index.dtype = np.dtype(dtype)
+        index.chunk_rows = chunk_rows
+        index.X = np.memmap(path, dtype=index.dtype, mode="r", shape=shape)
+        return index
+
+    @property
+    def ntotal(self) -> int:
+        return self.X.shape[0]
+
+    def search(self, Q: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        faiss と同じく (D, I) を返す（形状は (クエリ数, k)）。
+        mask で除外した行や候補不足分は I=-1, D=-inf で埋める。
+        """
+        Qn = _normalize_rows(_as_queries(Q))
+        m, n = Qn.shape[0], self.ntotal
+        if k <= 0:
+            return np.empty((m, 0), dtype=np.float32), np.empty((m, 0), dtype=np.int64)
+        step = self.chunk_rows or max(n, 1)
+        cand_D, cand_I = [], []
+        for s in range(0, n, step):
+            block = self.X[s : s + step]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            sims = Qn @ block.T  # (m, rows)
+            if mask is not None:
+                sims[:, ~mask[s : s + step]] = -np.inf
+            kk = min(k, sims.shape[1])
+            part = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+            cand_D.append(np.take_along_axis(sims, part, axis=1))
+            cand_I.append(part + s)
+
+        D = np.full((m, k), -np.inf, dtype=np.float32)
+        I = np.full((m, k), -1, dtype=np.int64)
+        if not cand_D:
+            return D, I
+        cD, cI = np.hstack(cand_D), np.hstack(cand_I)
+        kk = min(k, cD.shape[1])
+        part = np.argpartition(-cD, kk - 1, axis=1)[:, :kk]
+        pD = np.take_along_axis(cD, part, axis=1)
+        order = np.argsort(-pD, axis=1)
+        D[:, :kk] = np.take_along_axis(pD, order, axis=1)
+        I[:, :kk] = np.take_along_axis(np.take_along_axis(cI, part, axis=1), order, axis=1)
+        I[~np.isfinite(D)] = -1
+        return D, I
+
+
+class FaissIndex:
+    """faiss IndexFlatIP のラッパ。正規化はコピーに対して行い、呼び出し側の配列を変更しない。"""
+
+    def __init__(self, X: np.ndarray):
+        Xn = np.array(X, dtype=np.float32, order="C", copy=True)
+        faiss.normalize_L2(Xn)
+        self.index = faiss.IndexFlatIP(Xn.shape[1])
+        self.index.add(Xn)
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def search(self, Q: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        Qn = np.array(_as_queries(Q), dtype=np.float32, order="C", copy=True)
+        faiss.normalize_L2(Qn)
+        params = None
+        if mask is not None:
+            sel = faiss.IDSelectorBatch(np.flatnonzero(mask).astype("int64"))
+            params = faiss.SearchParameters(sel=sel)
+        return self.index.search(Qn, k, params=params)
+
+
+def build_index(X: np.ndarray, use_faiss: bool = True, **numpy_kwargs):
+    """faiss があれば IndexFlatIP、なければ NumpyIndex を返す（どちらも search(Q, k, mask)）。"""
+    if use_faiss and faiss is not None:
+        return FaissIndex(X)
+    return NumpyIndex(X, **numpy_kwargs)
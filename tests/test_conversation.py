@@ -0,0 +1,153 @@
+from rag.conversation import FakeCacheBackend, PlanConversation
+
+PLAN = {"title": "愛媛 旅程プラン", "summary": "", "days": [], "sources": []}
+CONTEXT = ["出典: 道後温泉本館 | https://www.iyokannet.jp/spot/1\n要点:\n- 日本最古といわれる温泉"]
+SOURCES = [{"title": "道後温泉本館", "url": "https://www.iyokannet.jp/spot/1", "site": "いよ観ネット"}]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_conversation(backend, clock, **kwargs):
+    return PlanConversation(
+        backend=backend, plan=dict(PLAN), context=CONTEXT, sources=SOURCES, clock=clock, **kwargs,
+    )
+
+
+def test_cache_is_built_once_and_reused_across_turns():
+    clock = Clock()
+    backend = FakeCacheBackend(clock=clock)
+    conv = make_conversation(backend, clock)
+
+    for req in ["2日目はゆったり", "温泉を追加", "昼食はグルメ"]:
+        new_plan, _ = conv.refine(req)
+        assert new_plan is not None
+
+    assert backend.calls.count("create") == 1
+    assert "delete" not in backend.calls
+    assert conv.history == ["2日目はゆったり", "温泉を追加", "昼食はグルメ"]
+    assert "昼食はグルメ" in conv.plan["summary"]
+    # 作成直後のターンは再利用に数えない
+    assert conv.metrics.cache_hit_turns == 2
+    assert 0 < conv.metrics.cached_tokens < conv.metrics.prompt_tokens
+
+
+def test_turn_delta_carries_current_plan_and_cache_holds_context():
+    clock = Clock()
+    seen = []
+
+    def responder(full_prompt):
+        seen.append(full_prompt)
+        return '{"title": "更新後", "days": []}'
+
+    backend = FakeCacheBackend(responder=responder, clock=clock)
+    conv = make_conversation(backend, clock)
+    conv.refine("1つ目")
+    conv.refine("2つ目")
+
+    (cached_text, _, _), = backend.caches.values()
+    assert "道後温泉本館" in cached_text
+    assert "愛媛 旅程プラン" not in cached_text  # プランはキャッシュに入れない
+    assert "更新後" in seen[1] and "- 1つ目" in seen[1]
+
+
+def test_ttl_is_extended_near_expiry_and_rebuilt_after_expiry():
+    clock = Clock()
+    backend = FakeCacheBackend(clock=clock)
+    conv = make_conversation(backend, clock, ttl_seconds=100, refresh_margin=10)
+
+    conv.refine("a")
+    clock.now = 95
+    conv.refine("b")
+    assert conv.metrics.cache_extends == 1
+
+    clock.now = 500
+    conv.refine("c")
+    assert conv.metrics.cache_builds == 2
+    assert conv.metrics.cache_hit_turns == 1
+
+
+def test_too_small_context_falls_back_without_retrying_create():
+    clock = Clock()
+    backend = FakeCacheBackend(min_cache_tokens=10**6, clock=clock)
+    conv = make_conversation(backend, clock)
+
+    conv.refine("a")
+    conv.refine("b")
+
+    assert backend.calls.count("create") == 1
+    assert conv.metrics.fallback_turns == 2
+    assert conv.metrics.cached_tokens == 0
+    assert conv.plan["summary"].endswith("（修正: b）")
+
+
+class FlakyBackend(FakeCacheBackend):
+    """指定した操作を、指定回数だけ一時的なエラー（429）で失敗させる。"""
+
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = dict(failures)
+
+    def _maybe_fail(self, op):
+        if self.failures.get(op, 0) > 0:
+            self.failures[op] -= 1
+            raise RuntimeError("429 RESOURCE_EXHAUSTED: quota exceeded")
+
+    def create(self, *args, **kwargs):
+        self._maybe_fail("create")
+        return super().create(*args, **kwargs)
+
+    def generate(self, model, contents, cached_content=None, system_instruction=None):
+        if cached_content:
+            self._maybe_fail("generate")
+        return super().generate(model, contents, cached_content, system_instruction)
+
+
+def test_transient_create_failure_is_retried_on_next_turn():
+    clock = Clock()
+    backend = FlakyBackend({"create": 1}, clock=clock)
+    conv = make_conversation(backend, clock)
+
+    conv.refine("a")
+    conv.refine("b")
+    conv.refine("c")
+
+    assert backend.calls.count("create") == 1  # 失敗した1回目は calls に残らない
+    assert conv.metrics.cache_builds == 1
+    assert conv.metrics.fallback_turns == 1
+    assert conv.metrics.cache_hit_turns == 1
+
+
+def test_transient_generate_failure_keeps_the_cache():
+    clock = Clock()
+    backend = FlakyBackend({"generate": 1}, clock=clock)
+    conv = make_conversation(backend, clock)
+
+    conv.refine("a")
+    conv.refine("b")
+
+    assert backend.calls.count("create") == 1
+    assert "delete" not in backend.calls
+    assert conv.metrics.fallback_turns == 1
+    assert conv.metrics.cache_hit_turns == 1
+    assert len(backend.caches) == 1
+
+
+def test_expired_cache_is_rebuilt_once_and_resent():
+    clock = Clock()
+    backend = FakeCacheBackend(clock=clock)
+    conv = make_conversation(backend, clock)
+
+    conv.refine("a")
+    backend.caches.clear()  # サーバ側で削除された
+    conv.refine("b")
+
+    assert backend.calls.count("create") == 2
+    assert conv.metrics.fallback_turns == 0
+    conv.close()
+    assert backend.caches == {}
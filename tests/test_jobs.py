@@ -0,0 +1,100 @@
+import threading
+import time
+
+from utils.jobs import CANCELLED, DONE, FAILED, JobManager
+
+
+def wait_finished(job, timeout=5.0):
+    deadline = time.time() + timeout
+    while not job.finished and time.time() < deadline:
+        time.sleep(0.01)
+    assert job.finished, f"job {job.id} still {job.status}"
+    return job
+
+
+def blocking(release, progress):
+    # キャンセル要求を progress 経由で拾えるよう、待ちながら報告し続ける
+    while not release.wait(0.01):
+        progress("待機中")
+    return "ok"
+
+
+def test_same_key_is_shared_and_cancelled_only_when_every_subscriber_cancels():
+    jobs = JobManager(max_workers=2)
+    release = threading.Event()
+    first = jobs.submit("plan", "k", blocking, release)
+    second = jobs.submit("plan", "k", blocking, release)
+    assert second is first and first.subscribers == 2
+
+    jobs.cancel(first.id)
+    assert not first.cancel_requested
+    jobs.cancel(first.id)
+    assert wait_finished(first).status == CANCELLED
+
+    # キャンセル済みのジョブには相乗りせず、新しく実行する
+    third = jobs.submit("plan", "k", blocking, release)
+    assert third is not first
+    release.set()
+    assert wait_finished(third).status == DONE and third.result == "ok"
+
+
+def test_cancel_while_pending_never_runs_the_job():
+    jobs = JobManager(max_workers=1)
+    release = threading.Event()
+    running = jobs.submit("plan", "a", blocking, release)
+    ran = []
+    queued = jobs.submit("plan", "b", lambda progress: ran.append(1))
+
+    jobs.cancel(queued.id)
+    release.set()
+
+    assert wait_finished(queued).status == CANCELLED
+    assert wait_finished(running).status == DONE
+    assert ran == []
+
+
+def test_cancellation_is_not_swallowed_by_except_exception():
+    jobs = JobManager(max_workers=1)
+    started, cancelled = threading.Event(), threading.Event()
+
+    def swallowing(progress):
+        started.set()
+        cancelled.wait(5)
+        try:
+            progress("検索")
+        except Exception:
+            return "swallowed"
+        return "unreachable"
+
+    job = jobs.submit("plan", "k", swallowing)
+    started.wait(5)
+    jobs.cancel(job.id)
+    cancelled.set()
+
+    assert wait_finished(job).status == CANCELLED
+    assert job.result is None
+
+
+def test_failures_are_recorded():
+    jobs = JobManager(max_workers=1)
+
+    def broken(progress):
+        raise RuntimeError("quota")
+
+    job = wait_finished(jobs.submit("plan", "k", broken))
+    assert job.status == FAILED and job.error == "RuntimeError: quota"
+
+
+def test_finished_jobs_are_pruned_after_ttl():
+    jobs = JobManager(max_workers=1, ttl_seconds=0.05)
+    old = wait_finished(jobs.submit("plan", "a", lambda progress: 1))
+    running_release = threading.Event()
+    running = jobs.submit("plan", "b", blocking, running_release)
+
+    time.sleep(0.1)
+    jobs.submit("plan", "c", lambda progress: 2)  # submit 時に期限切れを掃除する
+
+    assert jobs.get(old.id) is None
+    assert jobs.get(running.id) is running
+    running_release.set()
+    wait_finished(running)
@@ -0,0 +1,33 @@
+from rag.metadata import detect_months, filter_from_conditions, tag_chunk
+
+
+def test_dates_and_closures_are_not_season_tags():
+    tags = tag_chunk(
+        "道後温泉本館は日本最古といわれる温泉。休館日: 12月29日〜1月3日。2023年4月更新",
+        "道後温泉",
+    )
+    assert tags["months"] == []
+    f = filter_from_conditions("中予(松山・道後)", ["温泉", "グルメ"], "2026-08-10", 2)
+    assert f.matches(tags)
+
+
+def test_season_words_and_adjacent_ranges_are_tagged():
+    assert detect_months("石鎚山の紅葉は10月〜11月が見頃") == [10, 11]
+    assert detect_months("肱川あらし") == [1, 2, 3, 10, 11, 12]
+    assert detect_months("12月〜2月は休業") == []
+    assert detect_months("4月に開業した食堂") == []
+
+
+def test_place_and_product_names_are_not_season_words():
+    august = filter_from_conditions("指定なし", [], "2026-08-10", 2)
+    for text in ["梅津寺駅から海を望む", "佐藤さんの民宿", "今治市桜井の海岸", "雪見大福を買った", "蛍光灯の看板"]:
+        tags = tag_chunk(text)
+        assert tags["months"] == [], text
+        assert august.matches(tags), text
+
+
+def test_compound_season_words_are_tagged():
+    assert detect_months("七折梅林の梅の花") == [2, 3]
+    assert detect_months("道後公園の桜の開花") == [3, 4]
+    assert detect_months("石鎚山の雪景色") == [1, 2, 12]
+    assert detect_months("桜は3月下旬〜4月上旬") == [3, 4]
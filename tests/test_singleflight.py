@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from rag.singleflight import SingleFlight
+
+
+def run_threads(n, target):
+    results, errors = [None] * n, [None] * n
+
+    def worker(i):
+        try:
+            results[i] = target()
+        except BaseException as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    return results, errors
+
+
+def test_concurrent_threads_share_one_execution():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    runs = []
+
+    def fn():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return "ok"
+
+    def call():
+        return flight.do("k", fn)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    threading.Timer(0.2, release.set).start()
+    results, errors = run_threads(4, call)
+    leader.join(5)
+
+    assert results == ["ok"] * 4 and errors == [None] * 4
+    assert len(runs) == 1
+    assert flight.stats() == {"calls": 5, "executed": 1, "coalesced": 4, "inflight": 0}
+
+
+def test_error_is_propagated_to_every_waiter():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    leader = threading.Thread(target=lambda: pytest.raises(ValueError, flight.do, "k", fn))
+    leader.start()
+    started.wait(5)
+    threading.Timer(0.2, release.set).start()
+    _, errors = run_threads(3, lambda: flight.do("k", fn))
+    leader.join(5)
+
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert flight.stats()["executed"] == 1
+
+
+def test_thread_and_asyncio_callers_share_one_execution():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    runs = []
+
+    def fn():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return 42
+
+    thread_result = []
+    t = threading.Thread(target=lambda: thread_result.append(flight.do("k", fn)))
+    t.start()
+    started.wait(5)
+
+    async def waiters():
+        async def never_runs():
+            raise AssertionError("waiter must not execute")
+
+        tasks = [asyncio.create_task(flight.do_async("k", never_runs)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(waiters()) == [42, 42, 42]
+    t.join(5)
+    assert thread_result == [42] and len(runs) == 1
+
+
+def test_cancelled_leader_does_not_cancel_waiters():
+    flight = SingleFlight()
+    runs = []
+
+    async def fn():
+        runs.append(1)
+        await asyncio.sleep(0.2 if len(runs) == 1 else 0.1)
+        return len(runs)
+
+    async def scenario():
+        leader = asyncio.create_task(flight.do_async("k", fn))
+        await asyncio.sleep(0.02)
+        waiters = [asyncio.create_task(flight.do_async("k", fn)) for _ in range(2)]
+        thread_waiter = asyncio.create_task(asyncio.to_thread(flight.do, "k", lambda: time.sleep(0.1) or "thread"))
+        while flight.stats()["coalesced"] < 3:
+            await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*waiters, thread_waiter)
+
+    results = asyncio.run(scenario())
+    # 待機側のうち1つが引き継いで再実行し、残りはその結果を共有する
+    assert results in ([2, 2, 2], ["thread"] * 3)
+    assert flight.stats() == {"calls": 4, "executed": 2, "coalesced": 2, "inflight": 0}
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from rag.vector_index import NumpyIndex
+
+N, DIM = 500, 32
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((N, DIM)).astype(np.float32), rng.standard_normal((3, DIM)).astype(np.float32)
+
+
+def brute_force(X, Q, k, mask=None, dtype=np.float32):
+    Xn = (X / np.linalg.norm(X, axis=1, keepdims=True)).astype(dtype).astype(np.float32)
+    Qn = Q / np.linalg.norm(Q, axis=1, keepdims=True)
+    sims = Qn @ Xn.T
+    if mask is not None:
+        sims[:, ~mask] = -np.inf
+    I = np.argsort(-sims, axis=1)[:, :k]
+    return np.take_along_axis(sims, I, axis=1), I
+
+
+def assert_same(got, expected):
+    (D, I), (eD, eI) = got, expected
+    np.testing.assert_array_equal(I, eI)
+    np.testing.assert_allclose(D, eD, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("chunk_rows", [None, 64, 7])
+def test_search_matches_brute_force(data, chunk_rows):
+    X, Q = data
+    assert_same(NumpyIndex(X, chunk_rows=chunk_rows).search(Q, 10), brute_force(X, Q, 10))
+
+
+def test_float16_matches_brute_force_on_rounded_matrix(data):
+    X, Q = data
+    index = NumpyIndex(X, dtype="float16", chunk_rows=100)
+    assert index.X.dtype == np.float16
+    assert_same(index.search(Q, 10), brute_force(X, Q, 10, dtype=np.float16))
+
+
+def test_memmap_matches_in_memory(data, tmp_path):
+    X, Q = data
+    path = str(tmp_path / "index.f32")
+    index = NumpyIndex(X, chunk_rows=128, memmap_path=path)
+    assert isinstance(index.X, np.memmap)
+    assert_same(index.search(Q, 10), brute_force(X, Q, 10))
+
+    reopened = NumpyIndex.open_memmap(path, shape=(N, DIM), chunk_rows=128)
+    assert_same(reopened.search(Q, 10), brute_force(X, Q, 10))
+
+
+def test_mask_excludes_rows_and_pads_missing_candidates(data):
+    X, Q = data
+    mask = np.zeros(N, dtype=bool)
+    mask[[3, 50, 499]] = True
+    D, I = NumpyIndex(X, chunk_rows=64).search(Q, 5, mask=mask)
+
+    eD, eI = brute_force(X, Q, 3, mask=mask)
+    np.testing.assert_array_equal(I[:, :3], eI)
+    np.testing.assert_allclose(D[:, :3], eD, rtol=1e-5, atol=1e-5)
+    assert (I[:, 3:] == -1).all() and np.isneginf(D[:, 3:]).all()
+
+
+def test_k_larger_than_n_is_padded(data):
+    X, Q = data
+    D, I = NumpyIndex(X[:4], chunk_rows=3).search(Q[0], 6)
+    assert D.shape == I.shape == (1, 6)
+    assert sorted(I[0, :4]) == [0, 1, 2, 3]
+    assert (I[0, 4:] == -1).all() and np.isneginf(D[0, 4:]).all()
+    assert (np.diff(D[0, :4]) <= 0).all()
+
+
+def test_inputs_are_not_modified(data):
+    X, Q = data
+    X0, Q0 = X.copy(), Q.copy()
+    index = NumpyIndex(X)
+    index.search(Q, 5)
+    np.testing.assert_array_equal(X, X0)
+    np.testing.assert_array_equal(Q, Q0)
+    assert not np.shares_memory(index.X, X)
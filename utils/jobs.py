@@ -0,0 +1,118 @@
+from __future__ import annotations
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(BaseException):
+    """
+    協調的キャンセル: progress 報告の時点でキャンセル要求があれば送出される。
+    ジョブ本体の `except Exception` に握りつぶされないよう BaseException を継承する。
+    """
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    key: str
+    status: str = PENDING
+    stage: str = ""
+    progress: float = 0.0
+    result: Any = None
+    error: str = ""
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    subscribers: int = 1
+    _cancel: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel.is_set()
+
+    def report(self, stage: str, progress: Optional[float] = None) -> None:
+        """ジョブ本体から呼ぶ進捗コールバック。キャンセル済みなら JobCancelled。"""
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+        self.stage = stage
+        if progress is not None:
+            self.progress = max(0.0, min(1.0, float(progress)))
+
+
+class JobManager:
+    """
+    検索・RAG・生成を Streamlit のスクリプトスレッド外で実行する有界ワーカープール。
+    同じ key のジョブが実行中なら新規投入せず既存ジョブを共有する（再実行で重複させない）。
+    """
+
+    def __init__(self, max_workers: int = 4, ttl_seconds: float = 900):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ehime-job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._ttl = ttl_seconds
+
+    def submit(self, kind: str, key: str, fn: Callable[..., Any], *args, **kwargs) -> Job:
+        """fn(*args, progress=job.report, **kwargs) をバックグラウンドで実行する。"""
+        with self._lock:
+            self._prune()
+            for job in self._jobs.values():
+                if job.key == key and not job.finished and not job.cancel_requested:
+                    job.subscribers += 1
+                    return job
+            job = Job(id=uuid.uuid4().hex[:12], kind=kind, key=key)
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> None:
+        # 共有中のジョブは、購読者全員がキャンセルしたときだけ止める
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return
+            job.subscribers -= 1
+            if job.subscribers <= 0:
+                job._cancel.set()
+
+    def _run(self, job: Job, fn: Callable[..., Any], args, kwargs) -> None:
+        try:
+            job.report("開始", 0.0)
+            job.status = RUNNING
+            job.result = fn(*args, progress=job.report, **kwargs)
+            job.progress = 1.0
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self) -> None:
+        now = time.time()
+        stale = [
+            jid for jid, j in self._jobs.items()
+            if j.finished and j.finished_at is not None and now - j.finished_at > self._ttl
+        ]
+        for jid in stale:
+            del self._jobs[jid]